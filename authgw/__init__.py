@@ -0,0 +1,5 @@
+import django
+
+# django < 3.2 doesn't pick up AuthgwConfig on its own and we need its ready() to connect our signal receivers
+if django.VERSION < (3, 2):
+    default_app_config = 'authgw.apps.AuthgwConfig'
@@ -18,3 +18,7 @@ from django.apps import AppConfig
 class AuthgwConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authgw'
+
+    def ready(self):
+        # connect the user_logged_in receiver that saves the directory user snapshot to the session
+        from .utils import directory  # noqa: F401
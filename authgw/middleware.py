@@ -0,0 +1,16 @@
+from django.utils.functional import SimpleLazyObject
+
+from .utils.directory import get_directory_user
+
+
+class DirectoryUserMiddleware:
+    """
+    Adds request.directory_user which lazily loads the LdapUser snapshot saved to the session when logging in
+    NOTE: must come after SessionMiddleware and AuthenticationMiddleware in the MIDDLEWARE setting
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.directory_user = SimpleLazyObject(lambda: get_directory_user(request))
+        return self.get_response(request)
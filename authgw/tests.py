@@ -1,3 +1,499 @@
-from django.test import TestCase
+import re
+from unittest import mock
 
-# Create your tests here.
+from ldap3 import Connection, MOCK_SYNC, Server
+from ldap3.core.exceptions import LDAPBindError, LDAPException
+
+from django.contrib.auth import login
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+
+from .middleware import DirectoryUserMiddleware
+from .utils import directory
+from .utils.hierarchy import LdapOrgHierarchy, LdapUserIndex, PAGED_RESULTS_OID, normalize_dn
+from .utils.ldap3 import ActiveDirectoryAuthenticator, LdapAuthenticator, LdapUser
+
+
+# -------- stub directory --------
+class StubValue:
+    def __init__(self, value):
+        self.value = value
+
+
+class StubEntry:
+    """
+    Looks enough like an ldap3 entry for LdapUser.load()
+    """
+    def __init__(self, dn, manager_dn=None, **attributes):
+        values = {'distinguishedName': dn, 'cn': dn, 'givenName': None, 'sn': None, 'mail': None, 'c': None,
+                  'st': None, 'l': None, 'department': None, 'title': None, 'sAMAccountName': dn,
+                  'manager': manager_dn, 'memberOf': []}
+        values.update(attributes)
+        for name, value in values.items():
+            setattr(self, name, StubValue(value))
+
+
+class StubConnection:
+    """
+    Answers (|(attribute=value)...) searches on distinguishedName or manager and (sAMAccountName=*) paged searches
+        from a dict of dn -> manager dn
+    """
+    def __init__(self, directory, searches, bound=True, fail_searches=0):
+        self.directory = directory
+        self.searches = searches
+        self.bound = bound
+        self.fail_searches = fail_searches
+        self.entries = []
+        self.result = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def search(self, search_base, search_filter, attributes=None, paged_size=None, paged_cookie=None):
+        self.searches.append((search_filter, paged_cookie))
+        self.entries = []
+        if self.fail_searches:
+            self.fail_searches -= 1
+            self.result = {'result': 51, 'description': 'busy', 'message': ''}
+            return False
+        self.result = {'result': 0}
+        if search_filter == '(sAMAccountName=*)':
+            dns = list(self.directory)
+            start = paged_cookie or 0
+            end = start + paged_size
+            self.entries = [StubEntry(dn, self.directory[dn]) for dn in dns[start:end]]
+            cookie = end if end < len(dns) else b''
+            self.result['controls'] = {PAGED_RESULTS_OID: {'value': {'cookie': cookie}}}
+            return True
+        terms = re.findall(r'\((\w+)=([^()]*)\)', search_filter)
+        for dn, manager_dn in self.directory.items():
+            for attribute, value in terms:
+                matched = dn if attribute == 'distinguishedName' else manager_dn
+                if normalize_dn(matched) == value:
+                    self.entries.append(StubEntry(dn, manager_dn))
+                    break
+        return True
+
+
+class StubAuthenticator:
+    user_search_dn = 'OU=OFFICES,DC=example,DC=org'
+    user_search_query = '(sAMAccountName={})'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.searches = []
+        self.connections = 0
+        self.bound = True
+        self.fail_searches = 0
+
+    def get_bind_connection(self):
+        self.connections += 1
+        conn = StubConnection(self.directory, self.searches, self.bound, self.fail_searches)
+        self.fail_searches = 0
+        return conn
+
+    @staticmethod
+    def get_ldap_user_instance():
+        return LdapUser()
+
+
+def ldap_user_for(dn, manager_dn=None):
+    ldap_user = LdapUser()
+    ldap_user.load(StubEntry(dn, manager_dn))
+    return ldap_user
+
+
+def dns_for(ldap_users):
+    return [ldap_user.dn for ldap_user in ldap_users]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# -------- org hierarchy --------
+class LdapOrgHierarchyTests(TestCase):
+    # ceo <- vp <- (mgr1, mgr2); mgr1 <- dev
+    DIRECTORY = {
+        'CN=ceo,OU=X': None,
+        'CN=vp,OU=X': 'CN=ceo,OU=X',
+        'CN=mgr1,OU=X': 'CN=vp,OU=X',
+        'CN=mgr2,OU=X': 'CN=vp,OU=X',
+        'CN=dev,OU=X': 'CN=mgr1,OU=X',
+    }
+    # a and b manage each other; c reports into the loop
+    CYCLE = {
+        'CN=a,OU=X': 'CN=b,OU=X',
+        'CN=b,OU=X': 'CN=a,OU=X',
+        'CN=c,OU=X': 'CN=a,OU=X',
+    }
+
+    def setUp(self):
+        # synced hierarchies are shared through the cache
+        cache.clear()
+
+    def get_hierarchy(self, directory=None, ttl=300, sync_ttl=3600, batch_size=None):
+        self.authenticator = StubAuthenticator(directory or self.DIRECTORY)
+        return LdapOrgHierarchy(self.authenticator, LdapUserIndex(ttl=ttl, sync_ttl=sync_ttl), batch_size)
+
+    def test_get_users_splits_batches(self):
+        hierarchy = self.get_hierarchy(batch_size=2)
+        users = hierarchy.get_users(['CN=ceo,OU=X', 'CN=vp,OU=X', 'CN=dev,OU=X'])
+        self.assertEqual(sorted(users), ['cn=ceo,ou=x', 'cn=dev,ou=x', 'cn=vp,ou=x'])
+        self.assertEqual(len(self.authenticator.searches), 2)
+        self.assertEqual(self.authenticator.connections, 1)
+
+    def test_manager_chains_one_search_per_level(self):
+        hierarchy = self.get_hierarchy()
+        dev = ldap_user_for('CN=dev,OU=X', 'CN=mgr1,OU=X')
+        mgr2 = ldap_user_for('CN=mgr2,OU=X', 'CN=vp,OU=X')
+        chains = hierarchy.get_manager_chains([dev, mgr2])
+        self.assertEqual(dns_for(chains['cn=dev,ou=x']), ['CN=mgr1,OU=X', 'CN=vp,OU=X', 'CN=ceo,OU=X'])
+        self.assertEqual(dns_for(chains['cn=mgr2,ou=x']), ['CN=vp,OU=X', 'CN=ceo,OU=X'])
+        # level 1: mgr1 + vp, level 2: ceo (vp already known), level 3: nothing left to search
+        self.assertEqual(len(self.authenticator.searches), 2)
+        # everything is in the index now
+        self.assertEqual(dns_for(hierarchy.get_manager_chain(dev, max_depth=1)), ['CN=mgr1,OU=X'])
+        self.assertEqual(len(self.authenticator.searches), 2)
+
+    def test_get_reports_by_level(self):
+        hierarchy = self.get_hierarchy()
+        levels = hierarchy.get_reports(ldap_user_for('CN=ceo,OU=X'))
+        self.assertEqual([dns_for(level) for level in levels],
+                         [['CN=vp,OU=X'], ['CN=mgr1,OU=X', 'CN=mgr2,OU=X'], ['CN=dev,OU=X']])
+        searches = len(self.authenticator.searches)
+        hierarchy.get_reports(ldap_user_for('CN=ceo,OU=X'))
+        self.assertEqual(len(self.authenticator.searches), searches)
+
+    def test_cycle_live(self):
+        hierarchy = self.get_hierarchy(self.CYCLE)
+        chains = hierarchy.get_manager_chains([ldap_user_for(dn, manager_dn) for dn, manager_dn in self.CYCLE.items()])
+        self.assertEqual(dns_for(chains['cn=a,ou=x']), ['CN=b,OU=X'])
+        self.assertEqual(dns_for(chains['cn=b,ou=x']), ['CN=a,OU=X'])
+        self.assertEqual(dns_for(chains['cn=c,ou=x']), ['CN=a,OU=X', 'CN=b,OU=X'])
+
+    def test_cycle_snapshot_matches_live(self):
+        hierarchy = self.get_hierarchy(self.CYCLE)
+        snapshot = hierarchy.sync()
+        self.assertEqual(snapshot.chains, {
+            'cn=a,ou=x': ['cn=b,ou=x'],
+            'cn=b,ou=x': ['cn=a,ou=x'],
+            'cn=c,ou=x': ['cn=a,ou=x', 'cn=b,ou=x'],
+        })
+        searches = len(self.authenticator.searches)
+        self.assertEqual(dns_for(hierarchy.get_manager_chain(ldap_user_for('CN=b,OU=X', 'CN=a,OU=X'))),
+                         ['CN=a,OU=X'])
+        self.assertEqual(len(self.authenticator.searches), searches)
+
+    @override_settings(LDAP_HIERARCHY_PAGE_SIZE=2)
+    def test_sync_follows_paged_cookie(self):
+        hierarchy = self.get_hierarchy()
+        snapshot = hierarchy.sync()
+        self.assertEqual([cookie for search_filter, cookie in self.authenticator.searches], [None, 2, 4])
+        self.assertEqual(len(snapshot.users), 5)
+        self.assertEqual(snapshot.chains['cn=dev,ou=x'], ['cn=mgr1,ou=x', 'cn=vp,ou=x', 'cn=ceo,ou=x'])
+        self.assertEqual(sorted(snapshot.reports['cn=vp,ou=x']), ['cn=mgr1,ou=x', 'cn=mgr2,ou=x'])
+        # lookups come from the snapshot without searching
+        levels = hierarchy.get_reports(ldap_user_for('CN=vp,OU=X', 'CN=ceo,OU=X'))
+        self.assertEqual([dns_for(level) for level in levels], [['CN=mgr1,OU=X', 'CN=mgr2,OU=X'], ['CN=dev,OU=X']])
+        self.assertEqual(len(self.authenticator.searches), 3)
+
+    def test_ttl_expiry(self):
+        clock = Clock()
+        with mock.patch('time.monotonic', clock):
+            hierarchy = self.get_hierarchy(ttl=60)
+            hierarchy.get_users(['CN=vp,OU=X', 'CN=missing,OU=X'])
+            hierarchy.get_users(['CN=vp,OU=X', 'CN=missing,OU=X'])
+            self.assertEqual(len(self.authenticator.searches), 1)
+            clock.now += 61
+            hierarchy.get_users(['CN=vp,OU=X', 'CN=missing,OU=X'])
+            self.assertEqual(len(self.authenticator.searches), 2)
+            # expired entries are swept out when setting instead of kept forever
+            hierarchy.index.set('CN=ceo,OU=X', None)
+            clock.now += 61
+            hierarchy.index.set('CN=dev,OU=X', None)
+            self.assertEqual(list(hierarchy.index._users), ['cn=dev,ou=x'])
+
+    def test_snapshot_expires_after_sync_ttl(self):
+        clock = Clock()
+        with mock.patch('time.monotonic', clock), mock.patch('time.time', clock):
+            hierarchy = self.get_hierarchy(ttl=60, sync_ttl=600)
+            hierarchy.sync()
+            # the per dn ttl doesn't expire the synced hierarchy
+            clock.now += 61
+            hierarchy.get_users(['CN=vp,OU=X'])
+            self.assertEqual(len(self.authenticator.searches), 1)
+            clock.now += 600
+            hierarchy.get_users(['CN=vp,OU=X'])
+            self.assertEqual(len(self.authenticator.searches), 2)
+            self.assertIsNone(hierarchy.index.snapshot)
+
+    def test_snapshot_shared_through_cache(self):
+        # ex: a scheduled job syncs in its own process and the web workers pick it up from the cache
+        self.get_hierarchy().sync()
+        hierarchy = self.get_hierarchy()
+        chain = hierarchy.get_manager_chain(ldap_user_for('CN=dev,OU=X', 'CN=mgr1,OU=X'))
+        self.assertEqual(dns_for(chain), ['CN=mgr1,OU=X', 'CN=vp,OU=X', 'CN=ceo,OU=X'])
+        self.assertEqual(self.authenticator.searches, [])
+
+    def test_failed_search_is_not_cached(self):
+        hierarchy = self.get_hierarchy()
+        self.authenticator.fail_searches = 1
+        with self.assertRaises(LDAPException):
+            hierarchy.get_manager_chain(ldap_user_for('CN=dev,OU=X', 'CN=mgr1,OU=X'))
+        chain = hierarchy.get_manager_chain(ldap_user_for('CN=dev,OU=X', 'CN=mgr1,OU=X'))
+        self.assertEqual(dns_for(chain), ['CN=mgr1,OU=X', 'CN=vp,OU=X', 'CN=ceo,OU=X'])
+
+    def test_failed_bind_raises(self):
+        hierarchy = self.get_hierarchy()
+        self.authenticator.bound = False
+        with self.assertRaises(LDAPBindError):
+            hierarchy.get_users(['CN=vp,OU=X'])
+        with self.assertRaises(LDAPBindError):
+            hierarchy.sync()
+        self.assertIsNone(hierarchy.index.snapshot)
+        self.assertEqual(hierarchy.index.get('CN=vp,OU=X'), (False, None))
+
+
+# -------- authenticators --------
+class LdapAuthenticatorTests(TestCase):
+    BIND_DN = 'CN=bind,OU=SERVICE,OU=OFFICES,DC=example,DC=org'
+    USER_DN = 'CN=Bob Smith,OU=STAFF,OU=NYC,OU=OFFICES,DC=example,DC=org'
+
+    def setUp(self):
+        # ldap3's mock strategy keeps entries on the server so every connection we open sees the same directory
+        self.server = Server('mock')
+        conn = Connection(self.server, client_strategy=MOCK_SYNC)
+        conn.strategy.add_entry(self.BIND_DN, {'userPassword': 'bind-password', 'sAMAccountName': 'bind'})
+        conn.strategy.add_entry(self.USER_DN, {
+            'userPassword': 'bob-password', 'objectClass': 'person', 'distinguishedName': self.USER_DN,
+            'cn': 'Bob Smith', 'givenName': 'Bob', 'sn': 'Smith', 'mail': 'bob@example.org', 'c': 'US', 'st': 'NY',
+            'l': 'New York', 'department': 'IT', 'title': 'Developer', 'sAMAccountName': 'bob',
+            'manager': 'CN=Boss,OU=STAFF,OU=NYC,OU=OFFICES,DC=example,DC=org',
+            'memberOf': ['CN=Everyone,OU=GROUPS,DC=example,DC=org', 'CN=IT,OU=GROUPS,DC=example,DC=org']})
+        self.authenticator = LdapAuthenticator('mock', self.BIND_DN, 'bind-password', 'OU=OFFICES,DC=example,DC=org',
+                                               '(&(objectClass=person)(sAMAccountName={}))')
+        self.authenticator.get_ldap3_server = lambda: self.server
+
+        def mock_connection(*args, **kwargs):
+            return Connection(*args, client_strategy=MOCK_SYNC, **kwargs)
+        patcher = mock.patch('authgw.utils.ldap3.Connection', mock_connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_known_login_authenticates(self):
+        ldap_user = self.authenticator.get_ldap_user('bob', 'bob-password')
+        self.assertEqual(ldap_user.dn, self.USER_DN)
+        self.assertTrue(ldap_user.is_authenticated)
+
+    def test_unknown_login_is_not_authenticated(self):
+        # an empty dn would be an anonymous bind which succeeds for any password
+        ldap_user = self.authenticator.get_ldap_user('nosuchuser', 'wrong-password')
+        self.assertIsNone(ldap_user.dn)
+        self.assertFalse(ldap_user.is_authenticated)
+
+
+class CanLookupWithoutPasswordTests(TestCase):
+    def test_ldap_authenticator_never_can(self):
+        authenticator = LdapAuthenticator('host', 'CN=bind', 'password', 'OU=OFFICES', '(sAMAccountName={})')
+        self.assertFalse(authenticator.can_lookup_without_password())
+
+    def test_active_directory_needs_bind_user(self):
+        self.assertFalse(ActiveDirectoryAuthenticator('host', None, None, None, 'MYDOMAIN', 'OU=OFFICES',
+                                                      '(sAMAccountName={})').can_lookup_without_password())
+        self.assertFalse(ActiveDirectoryAuthenticator('host', 'bind', None, None, 'MYDOMAIN', 'OU=OFFICES',
+                                                      '(sAMAccountName={})').can_lookup_without_password())
+        self.assertTrue(ActiveDirectoryAuthenticator('host', 'bind', 'password', None, 'MYDOMAIN', 'OU=OFFICES',
+                                                     '(sAMAccountName={})').can_lookup_without_password())
+
+
+# -------- directory user snapshot --------
+def staff_ldap_user():
+    ldap_user = LdapUser()
+    ldap_user.load(StubEntry('CN=Bob Smith,OU=STAFF,OU=PEOPLE,OU=NYC,OU=OFFICES,DC=example,DC=org',
+                             'CN=Boss,OU=STAFF,OU=PEOPLE,OU=NYC,OU=OFFICES,DC=example,DC=org',
+                             sAMAccountName='bob', department='IT', title='Developer',
+                             memberOf=['CN=DJANGO_SUPERUSERS,OU=GROUPS,DC=example,DC=org',
+                                       'CN=Everyone,OU=GROUPS,DC=example,DC=org']))
+    ldap_user.is_authenticated = True
+    return ldap_user
+
+
+class StubLookupAuthenticator:
+    def __init__(self, ldap_user=None, error=None):
+        self.ldap_user = ldap_user
+        self.error = error
+        self.lookups = []
+        self.can_lookup = True
+
+    def can_lookup_without_password(self):
+        return self.can_lookup
+
+    @staticmethod
+    def get_ldap_user_instance():
+        return LdapUser()
+
+    def get_ldap_user(self, login, password=None):
+        self.lookups.append(login)
+        if self.error:
+            raise self.error
+        return self.ldap_user or LdapUser()
+
+
+class LdapUserSnapshotTests(TestCase):
+    def test_round_trip(self):
+        ldap_user = LdapUser()
+        self.assertTrue(ldap_user.load_snapshot(staff_ldap_user().to_snapshot()))
+        self.assertEqual(ldap_user.login, 'bob')
+        self.assertEqual(ldap_user.title, 'Developer')
+        self.assertEqual(ldap_user.office, 'NYC')
+        self.assertEqual(ldap_user.groups, ['DJANGO_SUPERUSERS', 'EVERYONE'])
+        self.assertTrue(ldap_user.is_it())
+        self.assertTrue(ldap_user.is_staff())
+        self.assertTrue(ldap_user.is_superuser())
+        self.assertTrue(ldap_user.is_authenticated)
+        # empty values are left out to keep it small
+        self.assertNotIn('sn', staff_ldap_user().to_snapshot())
+
+    def test_version_mismatch(self):
+        snapshot = staff_ldap_user().to_snapshot()
+        snapshot['v'] = LdapUser.SNAPSHOT_VERSION + 1
+        ldap_user = LdapUser()
+        self.assertFalse(ldap_user.load_snapshot(snapshot))
+        self.assertIsNone(ldap_user.dn)
+        self.assertFalse(ldap_user.load_snapshot(None))
+
+
+class DirectoryUserTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='bob')
+        self.authenticator = StubLookupAuthenticator(staff_ldap_user())
+        patcher = mock.patch.object(directory, 'get_ldap_authenticator', lambda: self.authenticator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_request(self, user=None, session=None):
+        request = RequestFactory().get('/')
+        request.session = session or SessionStore()
+        request.user = user or self.user
+        return request
+
+    def get_stale_request(self, age=7200):
+        request = self.get_request()
+        directory.save_directory_user(request, self.user, staff_ldap_user())
+        request.session[directory.SESSION_KEY]['created'] -= age
+        return request
+
+    def test_login_saves_snapshot(self):
+        self.user.ldap_user = staff_ldap_user()
+        self.user.backend = 'django.contrib.auth.backends.ModelBackend'
+        request = self.get_request()
+        login(request, self.user)
+        snapshot = request.session[directory.SESSION_KEY]
+        self.assertEqual(snapshot['username'], 'bob')
+        self.assertEqual(snapshot['user']['login'], 'bob')
+
+    def test_login_without_ldap_user_saves_nothing(self):
+        self.user.backend = 'django.contrib.auth.backends.ModelBackend'
+        request = self.get_request()
+        login(request, self.user)
+        self.assertNotIn(directory.SESSION_KEY, request.session)
+
+    def test_middleware_is_lazy(self):
+        request = self.get_request()
+        with mock.patch('authgw.middleware.get_directory_user', return_value=staff_ldap_user()) as get_directory_user:
+            DirectoryUserMiddleware(lambda r: None)(request)
+            get_directory_user.assert_not_called()
+            self.assertEqual(request.directory_user.office, 'NYC')
+            get_directory_user.assert_called_once_with(request)
+
+    def test_anonymous_user(self):
+        request = self.get_request(user=AnonymousUser())
+        DirectoryUserMiddleware(lambda r: None)(request)
+        self.assertIsNone(request.directory_user.dn)
+        self.assertFalse(request.directory_user.is_authenticated)
+
+    def test_local_password_user(self):
+        request = self.get_request()
+        DirectoryUserMiddleware(lambda r: None)(request)
+        self.assertIsNone(request.directory_user.dn)
+        self.assertFalse(request.directory_user.is_authenticated)
+
+    def test_user_with_snapshot(self):
+        request = self.get_request()
+        directory.save_directory_user(request, self.user, staff_ldap_user())
+        with mock.patch.object(directory.threading, 'Thread') as thread:
+            DirectoryUserMiddleware(lambda r: None)(request)
+            self.assertTrue(request.directory_user.is_it())
+            self.assertEqual(request.directory_user.groups, ['DJANGO_SUPERUSERS', 'EVERYONE'])
+            thread.assert_not_called()
+        self.assertEqual(self.authenticator.lookups, [])
+
+    def test_snapshot_for_another_user_is_ignored(self):
+        request = self.get_request()
+        directory.save_directory_user(request, User.objects.create(username='alice'), staff_ldap_user())
+        self.assertIsNone(directory.get_directory_user(request).dn)
+
+    def test_stale_snapshot_starts_one_refresh(self):
+        request = self.get_stale_request()
+        with mock.patch.object(directory.threading, 'Thread') as thread:
+            self.assertEqual(directory.get_directory_user(request).login, 'bob')
+            self.assertEqual(directory.get_directory_user(request).login, 'bob')
+            thread.assert_called_once()
+            self.assertEqual(thread.call_args.kwargs['target'], directory.refresh_directory_user_in_background)
+            self.assertEqual(thread.call_args.kwargs['args'], ('bob', 'bob', True))
+
+    def test_stale_snapshot_not_refreshed_without_password_lookup(self):
+        self.authenticator.can_lookup = False
+        request = self.get_stale_request()
+        with mock.patch.object(directory.threading, 'Thread') as thread:
+            self.assertEqual(directory.get_directory_user(request).login, 'bob')
+            thread.assert_not_called()
+
+    def test_background_refresh_closes_db_connections(self):
+        with mock.patch.object(directory, 'refresh_directory_user', side_effect=RuntimeError) as refresh, \
+                mock.patch.object(directory, 'connections') as connections:
+            with self.assertRaises(RuntimeError):
+                directory.refresh_directory_user_in_background('bob', 'bob', True)
+            refresh.assert_called_once_with('bob', 'bob', True)
+            connections.close_all.assert_called_once_with()
+
+    def test_refreshed_snapshot_is_picked_up(self):
+        request = self.get_stale_request()
+        self.authenticator.ldap_user.department = 'HR'
+        directory.refresh_directory_user('bob', 'bob', True)
+        self.assertEqual(self.authenticator.lookups, ['bob'])
+        ldap_user = directory.get_directory_user(request)
+        self.assertEqual(ldap_user.department, 'HR')
+        self.assertTrue(ldap_user.is_authenticated)
+        self.assertEqual(request.session[directory.SESSION_KEY]['user']['department'], 'HR')
+
+    def test_refresh_not_found_drops_snapshot(self):
+        request = self.get_stale_request()
+        self.authenticator.ldap_user = None
+        cache.add(directory.get_refresh_lock_key('bob'), True)
+        directory.refresh_directory_user('bob', 'bob', True)
+        self.assertIsNone(cache.get(directory.get_refresh_lock_key('bob')))
+        ldap_user = directory.get_directory_user(request)
+        self.assertIsNone(ldap_user.dn)
+        self.assertFalse(ldap_user.is_superuser())
+        self.assertNotIn(directory.SESSION_KEY, request.session)
+
+    def test_refresh_error_keeps_lock_and_snapshot(self):
+        request = self.get_stale_request()
+        self.authenticator.error = UnboundLocalError('user_dn')
+        cache.add(directory.get_refresh_lock_key('bob'), True)
+        directory.refresh_directory_user('bob', 'bob', True)
+        self.assertTrue(cache.get(directory.get_refresh_lock_key('bob')))
+        self.assertIsNone(cache.get(directory.get_cache_key('bob')))
+        self.assertEqual(directory.get_directory_user(request).login, 'bob')
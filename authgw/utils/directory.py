@@ -0,0 +1,142 @@
+"""
+Utilities for keeping a snapshot of the logged in users LdapUser so views don't have to query LDAP again
+NOTE: LdapBackend attaches the LdapUser to the django user when authenticating; once logged in we save a snapshot of
+    it to the session.  DirectoryUserMiddleware then exposes it as request.directory_user which is loaded lazily from
+    the session without any directory I/O.
+NOTE: when a snapshot is older than AUTHGW_DIRECTORY_USER_MAX_AGE seconds a background thread looks the user up again
+    using the bind user and stores the result in the cache; the next request picks it up and saves it to the session.
+    If the user is no longer in the directory the snapshot is dropped so we don't keep serving their old groups.
+    Lookups without a password require AD (LDAP_AUTHENTICATION = 'AD') with AD_BIND_USER and AD_BIND_PASSWORD set;
+    otherwise the snapshot is kept until the next login.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import caches
+from django.db import connections
+from django.dispatch import receiver
+from django.http import HttpRequest
+
+from .ldap3 import LdapUser, get_ldap_authenticator
+
+SESSION_KEY = '_authgw_directory_user'
+CACHE_KEY_PREFIX = 'authgw:directory_user:'
+
+
+def get_cache():
+    return caches[getattr(settings, 'AUTHGW_DIRECTORY_USER_CACHE', 'default')]
+
+
+def get_cache_key(username: str) -> str:
+    return f'{CACHE_KEY_PREFIX}{str(username).strip().lower()}'
+
+
+def get_refresh_lock_key(username: str) -> str:
+    return get_cache_key(username) + ':refreshing'
+
+
+def create_snapshot(username: str, ldap_user: LdapUser = None) -> dict:
+    """
+    Wrap the LdapUser snapshot with the django username it belongs to and when it was taken
+    :param username: django username the snapshot belongs to
+    :param ldap_user: ldap user to snapshot or None if the user is no longer in the directory
+    :return: ex: {'username': 'mylogin', 'created': 1700000000.0, 'user': {'v': 1, ...}}
+    """
+    return {'username': username, 'created': time.time(), 'user': ldap_user.to_snapshot() if ldap_user else None}
+
+
+def save_directory_user(request: HttpRequest, user, ldap_user: LdapUser):
+    """
+    Save a snapshot of the ldap user to the session for the logged in user
+    :param request: the request object; must have a session
+    :param user: the logged in django user
+    :param ldap_user: ldap user to save
+    """
+    request.session[SESSION_KEY] = create_snapshot(user.get_username(), ldap_user)
+
+
+def refresh_directory_user(username: str, login: str, is_authenticated: bool = False):
+    """
+    Look the user up again using the bind user and store the new snapshot in the cache for the next request
+    :param username: django username the snapshot belongs to
+    :param login: directory login to look up
+    :param is_authenticated: carried over from the original snapshot since looking up without a password never
+        authenticates
+    """
+    try:
+        ldap_user = get_ldap_authenticator().get_ldap_user(login)
+    except Exception as ex:
+        # we are on our own thread so nothing above us will handle this; leave the refresh lock in place so we
+        #   don't keep retrying until it expires and keep using the old snapshot in the meantime
+        print('Exception refreshing user record from LDAP')
+        print(ex)
+        return
+    if ldap_user.dn:
+        ldap_user.is_authenticated = is_authenticated
+    else:
+        # the user was disabled, moved or deleted; store an empty snapshot so the next request drops the old one
+        #   instead of serving stale groups (ex: DJANGO_SUPERUSERS)
+        ldap_user = None
+    get_cache().set(get_cache_key(username), create_snapshot(username, ldap_user),
+                    getattr(settings, 'AUTHGW_DIRECTORY_USER_MAX_AGE', 3600))
+    get_cache().delete(get_refresh_lock_key(username))
+
+
+def refresh_directory_user_in_background(username: str, login: str, is_authenticated: bool = False):
+    """
+    Thread target for refresh_directory_user; django opens a new db connection per thread (ex: if the cache is a
+        DatabaseCache) and nothing closes it when the thread ends so we close them ourselves
+    """
+    try:
+        refresh_directory_user(username, login, is_authenticated)
+    finally:
+        connections.close_all()
+
+
+def get_directory_user(request: HttpRequest) -> LdapUser:
+    """
+    Get the LdapUser for the logged in user from the session; never queries LDAP.  If the snapshot is older than
+        AUTHGW_DIRECTORY_USER_MAX_AGE a background refresh is started for the next request.
+    :param request: the request object; must have a user and session
+    :return: the LdapUser or an empty LdapUser (is_authenticated False) if there is no snapshot
+    """
+    authenticator = get_ldap_authenticator()
+    ldap_user = authenticator.get_ldap_user_instance()
+    user = getattr(request, 'user', None)
+    if not user or user.is_anonymous:
+        return ldap_user
+    username = user.get_username()
+    snapshot = request.session.get(SESSION_KEY)
+    if not snapshot or snapshot.get('username') != username:
+        return ldap_user
+    # if a background refresh finished since this snapshot was taken use it instead and save it to the session
+    refreshed = get_cache().get(get_cache_key(username))
+    if refreshed and refreshed.get('created', 0) > snapshot.get('created', 0):
+        if not refreshed.get('user'):
+            # the refresh didn't find the user in the directory anymore
+            del request.session[SESSION_KEY]
+            return ldap_user
+        request.session[SESSION_KEY] = refreshed
+        snapshot = refreshed
+    if not ldap_user.load_snapshot(snapshot.get('user')):
+        return ldap_user
+    max_age = getattr(settings, 'AUTHGW_DIRECTORY_USER_MAX_AGE', 3600)
+    # authenticators that need the users password to look them up (or are missing the bind user) keep the snapshot
+    #   until the next login
+    if authenticator.can_lookup_without_password() and time.time() - snapshot.get('created', 0) > max_age:
+        # only one refresh at a time; cache.add returns False if someone else already started one
+        if get_cache().add(get_refresh_lock_key(username), True, max_age):
+            threading.Thread(target=refresh_directory_user_in_background,
+                             args=(username, ldap_user.login or username, ldap_user.is_authenticated),
+                             daemon=True).start()
+    return ldap_user
+
+
+@receiver(user_logged_in)
+def save_directory_user_on_login(sender, request, user, **kwargs):
+    # LdapBackend attaches the ldap user when authenticating; save it now that the session is set up for this user
+    ldap_user = getattr(user, 'ldap_user', None)
+    if request is not None and ldap_user is not None and hasattr(request, 'session'):
+        save_directory_user(request, user, ldap_user)
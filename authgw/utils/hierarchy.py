@@ -0,0 +1,418 @@
+"""
+Utilities for resolving the management chain and reports of an LdapUser
+NOTE: LdapUser.manager_dn only points one level up; resolving a chain by calling get_ldap_user per hop means a bind
+    and search for every manager.  Instead we resolve level by level; every level is a single batched search
+    (ex: (|(distinguishedName=a)(distinguishedName=b))) for all DNs we still need at that level.
+NOTE: resolved users are kept in a DN -> LdapUser index that expires after LDAP_HIERARCHY_CACHE_TTL seconds so
+    repeated lookups for the same people do not hit the directory again
+NOTE: if you need lookups without any directory I/O call sync() (ex: from a scheduled job); it pages through every user
+    under LDAP_USER_SEARCH_DN once and stores the manager/report maps so lookups are O(1) until they expire after
+    LDAP_HIERARCHY_SYNC_TTL seconds.  The maps are saved to the LDAP_HIERARCHY_CACHE django cache so every process
+    sharing that cache uses them; with a per process cache (ex: the default LocMemCache) each process must sync itself.
+"""
+import threading
+import time
+
+from ldap3.core.exceptions import LDAPBindError, LDAPException
+from ldap3.utils.conv import escape_filter_chars
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .ldap3 import LdapUser, get_ldap_authenticator
+
+# the paged results control; used to page through all users during a sync
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+SNAPSHOT_CACHE_KEY = 'authgw:org_hierarchy'
+
+
+def get_cache():
+    return caches[getattr(settings, 'LDAP_HIERARCHY_CACHE', 'default')]
+
+
+def normalize_dn(dn: str) -> str:
+    """
+    DNs are case insensitive in LDAP/AD so we key everything on the lower case version
+    :param dn: ex: CN=First Last,OU=STAFF,OU=PEOPLE,OU=ASIA,OU=OFFICES,DC=example,DC=org
+    :return: lower case dn with surrounding whitespace removed or None
+    """
+    if not dn:
+        return None
+    return str(dn).strip().lower()
+
+
+class LdapUserIndex:
+    """
+    Thread safe DN -> LdapUser index where each entry expires after ttl seconds
+    NOTE: we also remember DNs that were searched for and not found so we don't keep searching for them
+    NOTE: expired entries are swept out at most once per ttl when setting so the index doesn't keep every DN it has
+        ever seen in a long running process
+    """
+    def __init__(self, ttl: int = None, sync_ttl: int = None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'LDAP_HIERARCHY_CACHE_TTL', 300)
+        self.sync_ttl = sync_ttl if sync_ttl is not None else getattr(settings, 'LDAP_HIERARCHY_SYNC_TTL', 86400)
+        self._lock = threading.Lock()
+        self._users = {}
+        self._reports = {}
+        self._pruned_at = time.monotonic()
+        # precomputed hierarchy from LdapOrgHierarchy.sync(); shared with everyone using this index
+        self.snapshot = None
+        self._snapshot_checked_at = None
+
+    def _is_fresh(self, stored_at: float) -> bool:
+        return (time.monotonic() - stored_at) < self.ttl
+
+    def _prune(self):
+        # NOTE: caller must hold the lock
+        if self._is_fresh(self._pruned_at):
+            return
+        self._users = {key: cached for key, cached in self._users.items() if self._is_fresh(cached[0])}
+        self._reports = {key: cached for key, cached in self._reports.items() if self._is_fresh(cached[0])}
+        self._pruned_at = time.monotonic()
+
+    def get(self, dn: str):
+        """
+        :param dn: dn to look up
+        :return: tuple of (found, ldap_user); found is False if not in the index or expired
+        """
+        key = normalize_dn(dn)
+        with self._lock:
+            cached = self._users.get(key)
+            if cached:
+                if self._is_fresh(cached[0]):
+                    return True, cached[1]
+                del self._users[key]
+        return False, None
+
+    def set(self, dn: str, ldap_user: LdapUser = None):
+        with self._lock:
+            self._prune()
+            self._users[normalize_dn(dn)] = (time.monotonic(), ldap_user)
+
+    def get_reports(self, manager_dn: str):
+        """
+        :param manager_dn: dn of the manager
+        :return: list of report dns or None if not in the index or expired
+        """
+        key = normalize_dn(manager_dn)
+        with self._lock:
+            cached = self._reports.get(key)
+            if cached:
+                if self._is_fresh(cached[0]):
+                    return cached[1]
+                del self._reports[key]
+        return None
+
+    def set_reports(self, manager_dn: str, report_dns: [str]):
+        with self._lock:
+            self._prune()
+            self._reports[normalize_dn(manager_dn)] = (time.monotonic(), list(report_dns))
+
+    def get_snapshot(self):
+        """
+        :return: the synced hierarchy or None if there isn't one or it expired
+        """
+        snapshot = self.snapshot
+        if snapshot and snapshot.is_fresh(self.sync_ttl):
+            return snapshot
+        # let go of an expired snapshot instead of holding every user in memory until the next sync
+        self.snapshot = None
+        # another process (ex: a scheduled job) may have synced; check the shared cache at most once per ttl so we
+        #   don't load it on every lookup when nobody syncs
+        if self._snapshot_checked_at is None or not self._is_fresh(self._snapshot_checked_at):
+            self._snapshot_checked_at = time.monotonic()
+            snapshot = get_cache().get(SNAPSHOT_CACHE_KEY)
+            if snapshot and snapshot.is_fresh(self.sync_ttl):
+                self.snapshot = snapshot
+                return snapshot
+        return None
+
+    def set_snapshot(self, snapshot):
+        self.snapshot = snapshot
+        get_cache().set(SNAPSHOT_CACHE_KEY, snapshot, self.sync_ttl)
+
+    def clear(self):
+        with self._lock:
+            self._users = {}
+            self._reports = {}
+            self.snapshot = None
+            self._snapshot_checked_at = None
+
+
+# shared by default so lookups from different requests use the same index
+default_index = LdapUserIndex()
+
+
+class OrgHierarchySnapshot:
+    """
+    Precomputed manager chains and direct reports built from a single pass over every user in the directory
+    """
+    def __init__(self, users: {str: LdapUser}):
+        # wall clock since the snapshot is shared with other processes through the cache
+        self.created = time.time()
+        self.users = users
+        self.reports = {}
+        for dn, ldap_user in users.items():
+            manager_key = normalize_dn(ldap_user.manager_dn)
+            if manager_key:
+                self.reports.setdefault(manager_key, []).append(dn)
+        # precompute the full chain for everyone so a lookup is a single dict access
+        self.chains = {}
+        for dn in users:
+            self._build_chain(dn)
+
+    def _build_chain(self, dn: str) -> [str]:
+        # walk up until we hit someone we already know the chain for or the top; guard against cycles (someone
+        #   managing themselves or a loop in bad directory data) by stopping when we see someone twice
+        path = []
+        current = dn
+        while current in self.users and current not in self.chains and current not in path:
+            path.append(current)
+            current = normalize_dn(self.users[current].manager_dn)
+        if current in path:
+            # we looped back; everyone on the loop reports up the rest of it and stops before reaching themselves
+            #   which is the same answer the live lookup gives
+            loop = path[path.index(current):]
+            for index, loop_dn in enumerate(loop):
+                self.chains[loop_dn] = loop[index + 1:] + loop[:index]
+            path = path[:path.index(current)]
+        chain = [current] + self.chains[current] if current in self.chains else []
+        # path is bottom up; fill in from the top down
+        for path_dn in reversed(path):
+            self.chains[path_dn] = chain
+            chain = [path_dn] + chain
+        return self.chains.get(dn, [])
+
+    def is_fresh(self, ttl: int) -> bool:
+        return (time.time() - self.created) < ttl
+
+
+class LdapOrgHierarchy:
+    """
+    Resolves manager chains and reports for LdapUser objects level by level using batched searches
+    NOTE: searches bind as the configured bind user (AD_BIND_USER or LDAP_BIND_DN) so those must be set
+    """
+    # attribute we search on to find a user by dn; AD exposes the dn as distinguishedName
+    dn_attribute = 'distinguishedName'
+    manager_attribute = 'manager'
+
+    def __init__(self, authenticator=None, index: LdapUserIndex = None, batch_size: int = None):
+        self.authenticator = authenticator or get_ldap_authenticator()
+        self.index = index or default_index
+        self.batch_size = batch_size or getattr(settings, 'LDAP_HIERARCHY_BATCH_SIZE', 100)
+
+    def get_ldap_user_instance(self):
+        return self.authenticator.get_ldap_user_instance()
+
+    def _get_snapshot(self):
+        return self.index.get_snapshot()
+
+    @staticmethod
+    def _check_connection(conn):
+        """
+        Raise instead of treating a failed bind or search as no results; otherwise we would cache everyone we
+            searched for as not found
+        """
+        if not conn.bound:
+            raise LDAPBindError('unable to bind as the bind user to search the org hierarchy')
+        result = conn.result or {}
+        if result.get('result', 0) != 0:
+            raise LDAPException(f"org hierarchy search failed: {result.get('description')} {result.get('message')}")
+
+    def _search(self, attribute: str, values: [str]) -> [LdapUser]:
+        """
+        Search for all users where attribute matches any of the values; split into batch_size chunks so the filter
+            doesn't get too large for the server but otherwise one search per call
+        """
+        ldap_users = []
+        if not values:
+            return ldap_users
+        with self.authenticator.get_bind_connection() as conn:
+            for start in range(0, len(values), self.batch_size):
+                batch = values[start:start + self.batch_size]
+                search_filter = '(|{})'.format(
+                    ''.join(f'({attribute}={escape_filter_chars(value)})' for value in batch))
+                conn.search(self.authenticator.user_search_dn, search_filter, attributes=['*'])
+                self._check_connection(conn)
+                for entry in conn.entries:
+                    ldap_user = self.get_ldap_user_instance()
+                    ldap_user.load(entry)
+                    ldap_users.append(ldap_user)
+        return ldap_users
+
+    def get_users(self, dns: [str]) -> {str: LdapUser}:
+        """
+        Get the LdapUser for each dn using the index and a single batched search for any we don't have
+        :param dns: list of dns to resolve
+        :return: dict of normalized dn -> LdapUser; dns that could not be found are not included
+        """
+        resolved = {}
+        missing = []
+        snapshot = self._get_snapshot()
+        for dn in dns:
+            key = normalize_dn(dn)
+            if not key or key in resolved or key in missing:
+                continue
+            if snapshot:
+                if key in snapshot.users:
+                    resolved[key] = snapshot.users[key]
+                continue
+            found, ldap_user = self.index.get(key)
+            if found:
+                if ldap_user:
+                    resolved[key] = ldap_user
+            else:
+                missing.append(key)
+        # NOTE: _search raises if the bind or search fails so we only get here after a successful search
+        for ldap_user in self._search(self.dn_attribute, missing):
+            key = normalize_dn(ldap_user.dn)
+            self.index.set(key, ldap_user)
+            resolved[key] = ldap_user
+        # remember the ones that are not in the directory so we don't keep searching for them
+        for key in missing:
+            if key not in resolved:
+                self.index.set(key, None)
+        return resolved
+
+    def get_manager_chains(self, ldap_users: [LdapUser], max_depth: int = None) -> {str: [LdapUser]}:
+        """
+        Resolve the management chain for several users at once; each level up is a single batched search for all
+            the managers we don't already know
+        :param ldap_users: list of LdapUser objects to resolve the chain for
+        :param max_depth: optional limit on how many levels to go up
+        :return: dict of normalized dn -> list of managers starting with the direct manager
+        """
+        chains = {}
+        snapshot = self._get_snapshot()
+        # pending is dn -> (last resolved user in the chain, dns already in the chain to guard against cycles)
+        pending = {}
+        for ldap_user in ldap_users:
+            key = normalize_dn(ldap_user.dn)
+            if snapshot and key in snapshot.chains:
+                chain = [snapshot.users[dn] for dn in snapshot.chains[key]]
+                chains[key] = chain[:max_depth] if max_depth is not None else chain
+                continue
+            chains[key] = []
+            pending[key] = (ldap_user, {key})
+        depth = 0
+        while pending and (max_depth is None or depth < max_depth):
+            managers = self.get_users([current.manager_dn for current, seen in pending.values()])
+            next_pending = {}
+            for key, (current, seen) in pending.items():
+                manager_key = normalize_dn(current.manager_dn)
+                manager = managers.get(manager_key)
+                if not manager or manager_key in seen:
+                    continue
+                chains[key].append(manager)
+                seen.add(manager_key)
+                next_pending[key] = (manager, seen)
+            pending = next_pending
+            depth += 1
+        return chains
+
+    def get_manager_chain(self, ldap_user: LdapUser, max_depth: int = None) -> [LdapUser]:
+        """
+        :param ldap_user: user to get the management chain for
+        :param max_depth: optional limit on how many levels to go up
+        :return: list of managers starting with the direct manager
+        """
+        return self.get_manager_chains([ldap_user], max_depth).get(normalize_dn(ldap_user.dn), [])
+
+    def get_direct_reports_for(self, manager_dns: [str]) -> {str: [LdapUser]}:
+        """
+        Get the direct reports for several managers using the index and a single batched search on the manager
+            attribute for any we don't already know
+        :param manager_dns: list of manager dns
+        :return: dict of normalized manager dn -> list of direct reports
+        """
+        reports = {}
+        cached = {}
+        missing = []
+        snapshot = self._get_snapshot()
+        for manager_dn in manager_dns:
+            key = normalize_dn(manager_dn)
+            if not key or key in reports or key in cached or key in missing:
+                continue
+            if snapshot:
+                reports[key] = [snapshot.users[dn] for dn in snapshot.reports.get(key, [])]
+                continue
+            report_dns = self.index.get_reports(key)
+            if report_dns is None:
+                missing.append(key)
+            else:
+                cached[key] = report_dns
+        if cached:
+            # resolve all the cached report dns together so any expired users are a single search
+            users = self.get_users([dn for report_dns in cached.values() for dn in report_dns])
+            for key, report_dns in cached.items():
+                reports[key] = [users[normalize_dn(dn)] for dn in report_dns if normalize_dn(dn) in users]
+        if missing:
+            for key in missing:
+                reports[key] = []
+            # search using the dns as we have them; keys are normalized but the directory doesn't care about case
+            for ldap_user in self._search(self.manager_attribute, missing):
+                self.index.set(ldap_user.dn, ldap_user)
+                manager_key = normalize_dn(ldap_user.manager_dn)
+                if manager_key in reports:
+                    reports[manager_key].append(ldap_user)
+            for key in missing:
+                self.index.set_reports(key, [ldap_user.dn for ldap_user in reports[key]])
+        return reports
+
+    def get_direct_reports(self, ldap_user: LdapUser) -> [LdapUser]:
+        """
+        :param ldap_user: manager to get the direct reports for
+        :return: list of direct reports
+        """
+        return self.get_direct_reports_for([ldap_user.dn]).get(normalize_dn(ldap_user.dn), [])
+
+    def get_reports(self, ldap_user: LdapUser, max_depth: int = None) -> [[LdapUser]]:
+        """
+        Get everyone under a manager level by level; each level is a single batched search
+        :param ldap_user: manager to get the reports for
+        :param max_depth: optional limit on how many levels to go down
+        :return: list of levels; index 0 is the direct reports, index 1 their reports and so on
+        """
+        levels = []
+        seen = {normalize_dn(ldap_user.dn)}
+        current = [ldap_user.dn]
+        while current and (max_depth is None or len(levels) < max_depth):
+            level = []
+            for level_reports in self.get_direct_reports_for(current).values():
+                for report in level_reports:
+                    key = normalize_dn(report.dn)
+                    if key not in seen:
+                        seen.add(key)
+                        level.append(report)
+            if not level:
+                break
+            levels.append(level)
+            current = [report.dn for report in level]
+        return levels
+
+    def sync(self) -> OrgHierarchySnapshot:
+        """
+        Page through every user under LDAP_USER_SEARCH_DN and precompute the hierarchy so lookups don't need
+            to search until the snapshot expires (LDAP_HIERARCHY_SYNC_TTL); run it more often than that
+        NOTE: expects LDAP_USER_SEARCH_QUERY to return every user when formatted with * ex: (sAMAccountName=*)
+        :return: the new snapshot
+        """
+        users = {}
+        page_size = getattr(settings, 'LDAP_HIERARCHY_PAGE_SIZE', 500)
+        search_filter = self.authenticator.user_search_query.format('*')
+        with self.authenticator.get_bind_connection() as conn:
+            cookie = None
+            while True:
+                conn.search(self.authenticator.user_search_dn, search_filter, attributes=['*'],
+                            paged_size=page_size, paged_cookie=cookie)
+                self._check_connection(conn)
+                for entry in conn.entries:
+                    ldap_user = self.get_ldap_user_instance()
+                    ldap_user.load(entry)
+                    users[normalize_dn(ldap_user.dn)] = ldap_user
+                cookie = conn.result.get('controls', {}).get(PAGED_RESULTS_OID, {}).get('value', {}).get('cookie')
+                if not cookie:
+                    break
+        snapshot = OrgHierarchySnapshot(users)
+        self.index.set_snapshot(snapshot)
+        return snapshot
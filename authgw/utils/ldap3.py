@@ -11,6 +11,11 @@ from django.conf import settings
 
 
 class LdapUser:
+    # bump when the snapshot format changes so old snapshots (ex: in sessions) are ignored instead of misread
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_FIELDS = ('dn', 'cn', 'gn', 'sn', 'country_code', 'state_code', 'city', 'department', 'email', 'title',
+                       'manager_dn', 'login', 'is_authenticated')
+
     dn = None
     cn = None
     gn = None               # givenName
@@ -101,6 +106,36 @@ class LdapUser:
             self.manager_dn = ldap_data_dict.manager.value
             self.groups_dn = ldap_data_dict.memberOf.value
 
+    def to_snapshot(self) -> dict:
+        """
+        Serialize to a compact json friendly dict that can be stored in the session or cache; groups are rebuilt
+            from groups_dn when loaded so only the dns are stored
+        :return: ex: {'v': 1, 'dn': 'CN=First Last,OU=STAFF,...', 'groups_dn': [...], ...}
+        """
+        snapshot = {'v': self.SNAPSHOT_VERSION}
+        for field in self.SNAPSHOT_FIELDS:
+            value = getattr(self, field)
+            # skip empty values to keep the snapshot small; they default to None on the class
+            if value is not None:
+                snapshot[field] = value if isinstance(value, bool) else str(value)
+        if self._groups_dn:
+            snapshot['groups_dn'] = [str(group_dn) for group_dn in self._groups_dn]
+        return snapshot
+
+    def load_snapshot(self, snapshot: dict) -> bool:
+        """
+        Load from a dict created by to_snapshot()
+        :param snapshot: dict created by to_snapshot()
+        :return: True if loaded or False if the snapshot is missing or from a different version
+        """
+        if not snapshot or snapshot.get('v') != self.SNAPSHOT_VERSION:
+            return False
+        for field in self.SNAPSHOT_FIELDS:
+            if field in snapshot:
+                setattr(self, field, snapshot[field])
+        self.groups_dn = snapshot.get('groups_dn', [])
+        return True
+
     def pprint(self):
         prettyprint(vars(self))
 
@@ -115,7 +150,6 @@ class LdapAuthenticator:
         or user logging in.  This can work for deployed machines using a bind user, however, ActiveDirectory is
         better generally since it is based on the login which we always know when a user tries to log in.
     """
-
     def __init__(self, host: str = None, bind_dn: str = None, bind_password: str = None, user_search_dn: str = None,
                  user_search_query: str = None):
         self.host = host or getattr(settings, 'LDAP_HOST', None)
@@ -142,6 +176,29 @@ class LdapAuthenticator:
     def get_ldap_user_instance():
         return LdapUser()
 
+    def can_lookup_without_password(self) -> bool:
+        """
+        we have to re-bind as the user to load them so we can't look anyone up without their password
+        :return: False
+        """
+        return False
+
+    def get_bind_connection(self) -> Connection:
+        """
+        making a function so searches that are not tied to a login (ex: org hierarchy) can bind as the bind user
+        :return: unbound ldap3 connection for the bind user; use as a context manager to bind
+        """
+        if not self.host:
+            raise LDAPConfigurationParameterError(
+                'LDAP_HOST setting was not found or passed as parameter during initialization')
+        if not self.bind_user:
+            raise LDAPConfigurationParameterError(
+                'LDAP_BIND_DN setting was not found or passed as parameter during initialization')
+        if not self.bind_password:
+            raise LDAPConfigurationParameterError(
+                'LDAP_BIND_PASSWORD setting was not found or passed as parameter during initialization')
+        return Connection(self.get_ldap3_server(), self.bind_user, self.bind_password)
+
     def get_ldap_user(self, login: str, password: str = None) -> LdapUser:
         # validate our settings to use for connecting
         # self.host = 'myldapserver.example.org'
@@ -183,15 +240,19 @@ class LdapAuthenticator:
                              attributes=['*'])
             # print(bind_conn)
             # print(bind_conn.entries)
+            user_dn = None
             if bind_conn.entries:
                 user_dn = bind_conn.entries[0]
             if user_dn:
                 ldap_user.load(user_dn)
             # one additional step that is not needed for AD; re-bind as user now that we have dn to set is_authenticated
             #   since we originally bound as a bind user we haven't verified the password yet
-            with Connection(server, ldap_user.dn, password) as conn:
-                if conn.bound:
-                    ldap_user.is_authenticated = True
+            # NOTE: never re-bind without a dn; ldap3 treats an empty user as an anonymous bind which would succeed
+            #   for any password if the server allows anonymous binds
+            if ldap_user.dn:
+                with Connection(server, ldap_user.dn, password) as conn:
+                    if conn.bound:
+                        ldap_user.is_authenticated = True
 
         return ldap_user
 
@@ -242,6 +303,29 @@ class ActiveDirectoryAuthenticator:
     def get_ldap_user_instance():
         return LdapUser()
 
+    def can_lookup_without_password(self) -> bool:
+        """
+        without a password we bind as AD_BIND_USER and look the user up so the bind user must be configured
+        :return: True if get_ldap_user(login) can be called without a password
+        """
+        return bool(self.host and self.bind_user and self.bind_password and self.user_search_dn and
+                    self.user_search_query)
+
+    def get_bind_connection(self) -> Connection:
+        """
+        making a function so searches that are not tied to a login (ex: org hierarchy) can bind as the bind user
+        :return: unbound ldap3 connection for the bind user; use as a context manager to bind
+        """
+        if not self.host:
+            raise LDAPConfigurationParameterError(
+                'LDAP_HOST setting was not found or passed as parameter during initialization')
+        bind_user = self.fix_username(self.bind_user)
+        if not bind_user:
+            raise LDAPConfigurationParameterError(
+                'AD_BIND_USER setting was not found or passed as parameter during initialization')
+        return Connection(self.get_ldap3_server(), user=bind_user, password=self.bind_password,
+                          authentication=NTLM)
+
     def get_ldap_user(self, login: str, password: str = None) -> LdapUser:
         """
         Get an LdapUser by connecting to AD
@@ -297,6 +381,7 @@ class ActiveDirectoryAuthenticator:
                 # attributes=['cn', 'distinguishedName', 'email'])
                 # print(conn)
                 # print(conn.entries)
+                user_dn = None
                 if conn.entries:
                     user_dn = conn.entries[0]
 
@@ -310,6 +395,18 @@ class ActiveDirectoryAuthenticator:
         return ldap_user
 
 
+def get_ldap_authenticator():
+    """
+    Get the authenticator configured by LDAP_AUTHENTICATION
+    we are going to default to using AD type authentication since it only binds once and therefore is faster
+    use LDAP_AUTHENTICATION = LDAP to change (default = AD)
+    :return: ActiveDirectoryAuthenticator or LdapAuthenticator instance
+    """
+    if getattr(settings, 'LDAP_AUTHENTICATION', 'AD') != 'LDAP':
+        return ActiveDirectoryAuthenticator()
+    return LdapAuthenticator()
+
+
 # CUSTOM BACKEND ADMIN OVERRIDE
 class LdapBackend(BaseBackend):
     """
@@ -324,12 +421,7 @@ class LdapBackend(BaseBackend):
         username = kwargs.get('username')
         password = kwargs.get('password')
         # check the username/password and return the user
-        # we are going to default to using AD type authentication since it only binds once and therefore is faster
-        # use LDAP_AUTHENTICATION = DN to change (default = AD)
-        if getattr(settings, 'LDAP_AUTHENTICATION', 'AD') != 'LDAP':
-            authenticator = ActiveDirectoryAuthenticator()
-        else:
-            authenticator = LdapAuthenticator()
+        authenticator = get_ldap_authenticator()
 
         try:
             ldap_user = authenticator.authenticate(username, password)
@@ -378,6 +470,8 @@ class LdapBackend(BaseBackend):
                             user.save()
                         else:
                             print(f'user already in {group.name}; skipping...')
+                # keep the ldap user so it can be saved to the session once logged in (see authgw.utils.directory)
+                user.ldap_user = ldap_user
         return user
 
     def get_user(self, user_id):